@@ -1,4 +1,5 @@
 from .modelica import ModelicaEnv
 from .plot import PlotTmpl
+from .vec_env import ModelicaVecEnv
 
-__all__ = ['ModelicaEnv', 'PlotTmpl']
+__all__ = ['ModelicaEnv', 'ModelicaVecEnv', 'PlotTmpl']
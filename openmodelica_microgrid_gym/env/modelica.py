@@ -1,15 +1,13 @@
 import logging
 import re
-from datetime import datetime
 from fnmatch import translate
-from functools import partial
+from os import devnull
 from os.path import basename
 from typing import Sequence, Callable, List, Union, Tuple, Optional, Mapping, Dict, Any
 
 import gym
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy
 from matplotlib.figure import Figure
 from pyfmi import load_fmu
 from pyfmi.fmi import FMUModelME2
@@ -21,6 +19,25 @@ from openmodelica_microgrid_gym.util import FullHistory, EmptyHistory
 logger = logging.getLogger(__name__)
 
 
+def _color_columns(pattern: np.ndarray) -> List[np.ndarray]:
+    """
+    Greedily groups the columns of a sparsity pattern such that no two columns of a group share a nonzero row.
+
+    :param pattern: 2d boolean array, True where the matrix might be nonzero
+    :return: list of arrays of column indices, one array per group
+    """
+    groups = []  # column indices and occupied rows of each group
+    for j, col in enumerate(pattern.T):
+        for cols, rows in groups:
+            if not (rows & col).any():
+                cols.append(j)
+                rows |= col
+                break
+        else:
+            groups.append(([j], col.copy()))
+    return [np.array(cols) for cols, _ in groups]
+
+
 class ModelicaEnv(gym.Env):
     """
     OpenAI gym Environment encapsulating an FMU model.
@@ -36,7 +53,8 @@ class ModelicaEnv(gym.Env):
                  model_input: Optional[Sequence[str]] = None,
                  model_output: Optional[Union[dict, Sequence[str]]] = None, model_path: str = '../fmu/grid.network.fmu',
                  viz_mode: Optional[str] = 'episode', viz_cols: Optional[Union[str, List[Union[str, PlotTmpl]]]] = None,
-                 history: EmptyHistory = FullHistory()):
+                 history: EmptyHistory = FullHistory(), log_file_name: Optional[str] = None,
+                 solver_warm_start: bool = False):
         """
         Initialize the Environment.
         The environment can only be used after reset() is called.
@@ -51,7 +69,15 @@ class ModelicaEnv(gym.Env):
             It should return np.nan or -np.inf or None in case of a failiure.
             It should have no side-effects
         :param log_level: logging granularity. see logging in stdlib
-        :param solver_method: solver of the scipy.integrate.solve_ivp function
+        :param solver_method: integration method used to advance the FMU by one time step
+
+            - 'RK4': a single step of the classical 4th order Runge-Kutta method per time step.
+              Avoids the setup overhead of the scipy solvers, but the time step must be small
+              compared to the time constants of the model.
+            - 'CVode': the interval is integrated by the CVode solver of PyFMI (requires Assimulo).
+              The integration runs entirely in compiled code without calling back into Python.
+              The tolerances are the defaults of PyFMI.
+            - any other string names a scipy.integrate.OdeSolver (e.g. 'LSODA', 'BDF', 'RK45')
         :param max_episode_steps: maximum number of episode steps.
             The end time of the episode is calculated by the time resolution and the number of steps.
 
@@ -60,7 +86,7 @@ class ModelicaEnv(gym.Env):
 
         :param model_params: parameters of the FMU.
 
-            dictionary of variable names and scalars or callables.
+            dictionary of variable names and scalars or callables. Scalars are passed to the fmu once per episode.
             If a callable is provided it is called every time step with the current time.
             This callable must return a float that is passed to the fmu.
         :param model_input: list of strings. Each string representing a FMU input variable.
@@ -87,6 +113,13 @@ class ModelicaEnv(gym.Env):
                                 to match all data series ending with ".i".
              - list of PlotTmpl: Each template will result in a plot
         :param history: history to store observations and measurement (from the agent) after each step
+        :param log_file_name: file the FMU writes its log messages to.
+            If None, the log is discarded (PyFMI would otherwise create "<model>_log.txt" in the working directory)
+            and the log level is set to 0, so error messages of the FMU are not reported either.
+        :param solver_warm_start: if True, the scipy solvers start each time step with the largest step size
+            of the previous time step instead of estimating an initial step size.
+            This saves derivative evaluations, but changes the results within the tolerance of the solver.
+            The error can be several times larger than without warm start.
         """
         if model_input is None:
             raise ValueError('Please specify model_input variables from your OM FMU.')
@@ -94,17 +127,37 @@ class ModelicaEnv(gym.Env):
             raise ValueError('Please specify model_output variables from your OM FMU.')
         if viz_mode not in self.viz_modes:
             raise ValueError(f'Please select one of the following viz_modes: {self.viz_modes}')
+        if solver_method not in {'RK4', 'CVode'}:
+            self._solver_cls = getattr(integrate, solver_method, None)
+            if not (isinstance(self._solver_cls, type) and issubclass(self._solver_cls, integrate.OdeSolver)
+                    and self._solver_cls is not integrate.OdeSolver):
+                raise ValueError(f'Please select "RK4", "CVode" or a scipy.integrate.OdeSolver as solver_method, '
+                                 f'not {solver_method}')
+            # only the implicit solvers make use of the jacobian
+            self._solver_kwargs = dict(jac=self._calc_jac) if solver_method in {'Radau', 'BDF', 'LSODA'} else dict()
 
         self.viz_mode = viz_mode
         logger.setLevel(log_level)
         self.solver_method = solver_method
+        self._solver_warm_start = solver_warm_start
+        # largest step size of the scipy solver in the last time step
+        self._solver_step = None
 
         # load model from fmu
         model_name = basename(model_path)
         logger.debug("Loading model {}".format(model_name))
-        self.model: FMUModelME2 = load_fmu(model_path,
-                                           log_file_name=datetime.now().strftime(f'%Y-%m-%d_{model_name}.txt'))
+        # PyFMI always opens a log file, hence it is redirected to the null device if no log is requested
+        log_kwargs = dict(log_file_name=devnull, log_level=0) if log_file_name is None \
+            else dict(log_file_name=log_file_name)
+        self.model: FMUModelME2 = load_fmu(model_path, **log_kwargs)
         logger.debug("Successfully loaded model {}".format(model_name))
+        if solver_method == 'CVode':
+            # continue from the current state of the FMU instead of initializing it again on every call
+            self._sim_opts = self.model.simulate_options()
+            self._sim_opts['solver'] = 'CVode'
+            self._sim_opts['initialize'] = False
+            self._sim_opts['ncp'] = 0
+            self._sim_opts['result_handling'] = 'memory'
 
         # if you reward policy is different from just reward/penalty - implement custom step method
         self.reward = reward_fun
@@ -117,20 +170,24 @@ class ModelicaEnv(gym.Env):
         self.time_end = np.inf if max_episode_steps is None \
             else self.time_start + max_episode_steps * self.time_step_size
 
-        # if there are parameters, we will convert all scalars to constant functions.
+        # scalar parameters are set once per episode, only the callables need to be evaluated every step
         model_params = model_params or dict()
-        # the "partial" is needed because of some absurd python behaviour https://stackoverflow.com/a/34021333/13310191
-        self.model_parameters = {var: (val if callable(val) else partial(lambda t, val_: val_, val_=val)) for var, val
-                                 in
-                                 model_params.items()}
-
-        self.sim_time_interval = None
+        self._const_params = {var: val for var, val in model_params.items() if not callable(val)}
+        self._dyn_params = {var: val for var, val in model_params.items() if callable(val)}
+        self._dyn_param_names = list(self._dyn_params)
+        self._dyn_param_funcs = list(self._dyn_params.values())
+
+        # start time of the next simulated interval
+        self._t = self.time_start
+        self._done = False
         self._state = []
         self.measurement = []
         self.record_states = viz_mode == 'episode'
         self.history = history
         self.history.cols = model_output
-        self.model_input_names = model_input
+        self.model_input_names = tuple(model_input)
+        # PyFMI expects a list of names
+        self._input_names_list = list(self.model_input_names)
         # variable names are flattened to a list if they have specified in the nested dict manner)
         self.model_output_names = self.history.cols
 
@@ -138,24 +195,28 @@ class ModelicaEnv(gym.Env):
         if viz_cols is None:
             logger.info('Provide the option "viz_cols" if you wish to select only specific plots. '
                         'The default behaviour is to plot all data series')
-            self.viz_col_regex = '.*'
+            self._viz_match = re.compile('.*').fullmatch
         elif isinstance(viz_cols, list):
             # strings are glob patterns that can be used in the regex
-            patterns, tmpls = [], []
+            globs, tmpls = [], []
             for elem in viz_cols:
                 if isinstance(elem, str):
-                    patterns.append(translate(elem))
+                    globs.append(elem)
                 elif isinstance(elem, PlotTmpl):
                     tmpls.append(elem)
                 else:
                     raise ValueError('"viz_cols" list must contain only strings or PlotTmpl objects not'
                                      f' {type(viz_cols)}')
 
-            self.viz_col_regex = '|'.join(patterns)
+            if any(c in glob for glob in globs for c in '*?['):
+                self._viz_match = re.compile('|'.join(map(translate, globs))).fullmatch
+            else:
+                # without wildcards the globs are plain column names
+                self._viz_match = frozenset(globs).__contains__
             self.viz_col_tmpls = tmpls
         elif isinstance(viz_cols, str):
             # is directly interpret as regex
-            self.viz_col_regex = viz_cols
+            self._viz_match = re.compile(viz_cols).fullmatch
         else:
             raise ValueError('"viz_cols" must be one type Optional[Union[str, List[Union[str, PlotTmpl]]]]'
                              f'and not {type(viz_cols)}')
@@ -185,24 +246,74 @@ class ModelicaEnv(gym.Env):
         self.model.enter_continuous_time_mode()
 
         # precalculating indices for more efficient lookup
-        self.model_output_idx = np.array([self.model.get_variable_valueref(k) for k in self.model_output_names])
+        # value references are stored as uint32 (fmi2ValueReference), so that PyFMI does not need to convert them
+        self.model_output_idx = np.fromiter((self.model.get_variable_valueref(k) for k in self.model_output_names),
+                                            dtype=np.uint32, count=len(self.model_output_names))
+        # state and derivative value references for the directional derivatives
+        self._state_refs = np.fromiter((s.value_reference for s in self.model.get_states_list().values()),
+                                       dtype=np.uint32)
+        self._deriv_refs = np.fromiter((s.value_reference for s in self.model.get_derivatives_list().values()),
+                                       dtype=np.uint32)
+
+        # buffers reused in every call of the derivative and jacobian callbacks
+        n = len(self._state_refs)
+        self._x_buf = np.empty(n)
+        # the jacobian is filled column by column, hence it is stored in column-major order.
+        # entries outside of the sparsity pattern are never written and stay zero
+        self._jac_buf = np.zeros((n, n), order='F')
+
+        # sparsity pattern of the jacobian from the structural dependencies declared by the FMU
+        states = list(self.model.get_states_list())
+        state_idx = {name: i for i, name in enumerate(states)}
+        state_deps, _ = self.model.get_derivatives_dependencies()
+        pattern = np.zeros((n, n), dtype=bool)
+        for i, der in enumerate(self.model.get_derivatives_list()):
+            pattern[i, [state_idx[var] for var in state_deps.get(der, states) if var in state_idx]] = True
+        # the declared dependencies are checked against the jacobian of the initial state
+        if np.any(self._dense_jac()[~pattern]):
+            logger.warning('The dependencies declared by the FMU do not match its jacobian, '
+                           'falling back to a dense jacobian')
+            pattern[:] = True
+
+        # columns without common nonzero rows are retrieved by a single directional derivative
+        self._jac_colors = []
+        for cols in _color_columns(pattern):
+            seed = np.zeros(n)
+            seed[cols] = 1
+            rows, col_pos = np.nonzero(pattern[:, cols])
+            self._jac_colors.append((seed, rows, cols[col_pos]))
+
+    def _dense_jac(self) -> np.ndarray:
+        """
+        Compose the Jacobian matrix with one directional derivative per state, ignoring any sparsity.
+
+        :return: the Jacobian matrix
+        """
+        n = len(self._state_refs)
+        jacobian = np.empty((n, n), order='F')
+        seed = np.zeros(n)
+        for j in range(n):
+            seed[j] = 1
+            jacobian[:, j] = self.model.get_directional_derivative(self._state_refs, self._deriv_refs, seed)
+            seed[j] = 0
+        return jacobian
 
     def _calc_jac(self, t, x) -> np.ndarray:  # noqa
         """
         Compose Jacobian matrix from the directional derivatives of the FMU model.
-        This function will be called by the scipy.integrate.solve_ivp solver,
+        This function will be called by the scipy.integrate solvers,
         therefore we have to obey the expected signature.
 
         :param t: time (ignored)
         :param x: state (ignored)
-        :return: the Jacobian matrix
+        :return: the Jacobian matrix (the same buffer is overwritten on every call)
         """
-        # get state and derivative value reference lists
-        refs = [[s.value_reference for s in getattr(self.model, attr)().values()]
-                for attr in
-                ['get_states_list', 'get_derivatives_list']]
-        jacobian = np.identity(len(refs[1]))
-        np.apply_along_axis(lambda col: self.model.get_directional_derivative(*refs, col), 0, jacobian)
+        jacobian = self._jac_buf
+        # the directional derivative in the direction of the sum of the unit vectors of a color
+        # contains the nonzero entries of all columns of that color
+        for seed, rows, cols in self._jac_colors:
+            dz = self.model.get_directional_derivative(self._state_refs, self._deriv_refs, seed)
+            jacobian[rows, cols] = dz[rows]
         return jacobian
 
     def _get_deriv(self, t: float, x: np.ndarray) -> np.ndarray:
@@ -214,12 +325,29 @@ class ModelicaEnv(gym.Env):
         :return: 1d float array of derivatives
         """
         self.model.time = t
-        self.model.continuous_states = x.copy(order='C')
+        # the FMU needs a C-contiguous array, the solvers might pass views
+        np.copyto(self._x_buf, x)
+        self.model.continuous_states = self._x_buf
 
         # Compute the derivative
         dx = self.model.get_derivatives()
         return dx
 
+    def _rk4_step(self, t: float, x: np.ndarray, h: float) -> np.ndarray:
+        """
+        Performs a single step of the classical 4th order Runge-Kutta method on the FMU derivatives.
+
+        :param t: time at the beginning of the step
+        :param x: 1d float array of continuous states at time t
+        :param h: step size
+        :return: 1d float array of continuous states at time t + h
+        """
+        k1 = self._get_deriv(t, x)
+        k2 = self._get_deriv(t + h / 2, x + h / 2 * k1)
+        k3 = self._get_deriv(t + h / 2, x + h / 2 * k2)
+        k4 = self._get_deriv(t + h, x + h * k3)
+        return x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
     def _simulate(self) -> np.ndarray:
         """
         Executes simulation by FMU in the time interval [start_time; stop_time]
@@ -227,16 +355,31 @@ class ModelicaEnv(gym.Env):
 
         :return: resulting state of the environment
         """
-        logger.debug(f'Simulation started for time interval {self.sim_time_interval[0]}-{self.sim_time_interval[1]}')
+        t_0, t_1 = self._t, self._t + self.time_step_size
+        logger.debug('Simulation started for time interval %s-%s', t_0, t_1)
 
         # Advance
-        x_0 = self.model.continuous_states
-
-        # Get the output from a step of the solver
-        sol_out = scipy.integrate.solve_ivp(
-            self._get_deriv, self.sim_time_interval, x_0, method=self.solver_method, jac=self._calc_jac)
-        # get the last solution of the solver
-        self.model.continuous_states = sol_out.y[:, -1]  # noqa
+        if self.solver_method == 'RK4':
+            self.model.continuous_states = self._rk4_step(t_0, self.model.continuous_states, self.time_step_size)
+        elif self.solver_method == 'CVode':
+            self.model.simulate(t_0, t_1, options=self._sim_opts)
+        else:
+            x_0 = self.model.continuous_states
+            # the solver is stepped directly to avoid the overhead of solve_ivp collecting the whole solution.
+            # with warm start, it starts with the largest step size of the previous interval
+            first_step = None if self._solver_step is None else min(self._solver_step, t_1 - t_0)
+            solver = self._solver_cls(self._get_deriv, t_0, x_0, t_1, first_step=first_step, **self._solver_kwargs)
+            step_size = 0
+            while solver.status == 'running':
+                message = solver.step()
+                if solver.status == 'failed':
+                    logger.warning('Solver failed in time interval %s-%s: %s', t_0, t_1, message)
+                    break
+                step_size = max(step_size, solver.step_size)
+            if self._solver_warm_start:
+                self._solver_step = step_size or None
+            # get the last solution of the solver
+            self.model.continuous_states = solver.y
 
         obs = self.model.get_real(self.model_output_idx)
         return obs
@@ -244,16 +387,12 @@ class ModelicaEnv(gym.Env):
     @property
     def is_done(self) -> bool:
         """
-        Checks if the experiment is finished using a time limit
+        Checks if the experiment is finished using a time limit or because of an extreme reward.
+        It is updated at the end of every step.
 
-        :return: True if simulation time exceeded
+        :return: True if the next step would exceed the simulation time or the last reward indicated a failure
         """
-        if self._failed:
-            logger.info(f'reward was extreme, episode terminated')
-            return True
-        # TODO allow for other stopping criteria
-        logger.debug(f't: {self.sim_time_interval[1]}, ')
-        return abs(self.sim_time_interval[1]) > self.time_end
+        return self._done
 
     def reset(self) -> np.ndarray:
         """
@@ -271,12 +410,20 @@ class ModelicaEnv(gym.Env):
         self.model.setup_experiment(start_time=0)
 
         self._setup_fmu()
-        self.sim_time_interval = np.array([self.time_start, self.time_start + self.time_step_size])
+        self._t = self.time_start
+        self._solver_step = None
         self.history.reset()
+        if self.max_episode_steps is not None:
+            # the initial state and one row per step
+            self.history.preallocate(self.max_episode_steps + 1, len(self.history.cols))
         self._state = self._simulate()
+        # the reset of the model discarded all parameters
+        if self._const_params:
+            self.model.set(list(self._const_params), list(self._const_params.values()))
         self.measurement = []
         self.history.append(self._state)
         self._failed = False
+        self._done = self._t + self.time_step_size > self.time_end
 
         return self._state
 
@@ -291,7 +438,7 @@ class ModelicaEnv(gym.Env):
         :return: state, reward, is done, info
         """
         logger.debug("Experiment next step was called.")
-        if self.is_done:
+        if self._done:
             logger.warning(
                 """You are calling 'step()' even though this environment has already returned done = True.
                 You should always call 'reset()' once you receive 'done = True' -- any further steps are
@@ -306,40 +453,41 @@ class ModelicaEnv(gym.Env):
             logger.warning("Model input values (action) should be passed as a list")
 
         # Check if number of model inputs equals number of values passed
-        if len(action) != len(list(self.model_input_names)):
-            message = f'List of values for model inputs should be of the length {len(list(self.model_input_names))},'
-            f'equal to the number of model inputs. Actual length {len(action)}'
+        if len(action) != len(self._input_names_list):
+            message = (f'List of values for model inputs should be of the length {len(self._input_names_list)},'
+                       f'equal to the number of model inputs. Actual length {len(action)}')
             logger.error(message)
             raise ValueError(message)
 
         # Set input values of the model
         logger.debug('model input: %s, values: %s', self.model_input_names, action)
-        self.model.set(list(self.model_input_names), list(action))
-        if self.model_parameters:
-            values = [(var, f(self.sim_time_interval[0])) for var, f in self.model_parameters.items()]
-            # list of keys and list of values
-            self.model.set(*zip(*values))
+        self.model.set(self._input_names_list, action if isinstance(action, list) else list(action))
+        if self._dyn_params:
+            t = self._t
+            self.model.set(self._dyn_param_names, [f(t) for f in self._dyn_param_funcs])
 
         # Simulate and observe result state
         self._state = self._simulate()
-        obs = np.hstack((self._state, self.measurement))
+        obs = np.concatenate((self._state, self.measurement))
         self.history.append(obs)
 
         logger.debug("model output: %s, values: %s", self.model_output_names, self._state)
 
-        # Check if experiment has finished
-        # Move simulation time interval if experiment continues
-        if not self.is_done:
-            logger.debug("Experiment step done, experiment continues.")
-            self.sim_time_interval += self.time_step_size
-        else:
-            logger.debug("Experiment step done, experiment done.")
+        # Move simulation time interval
+        self._t += self.time_step_size
 
         reward = self.reward(self.history.cols, obs)
         self._failed = np.isnan(reward) or np.isinf(reward) and reward < 0 or reward is None
+        if self._failed:
+            logger.info('reward was extreme, episode terminated')
+
+        # Check if experiment has finished
+        # TODO allow for other stopping criteria
+        self._done = self._failed or self._t + self.time_step_size > self.time_end
+        logger.debug('Experiment step done, experiment done: %s', self._done)
 
         # only return the state, the agent does not need the measurement
-        return obs, reward, self.is_done, {}
+        return obs, reward, self._done, {}
 
     def render(self, mode: str = 'human', close: bool = False) -> List[Figure]:
         """
@@ -358,16 +506,18 @@ class ModelicaEnv(gym.Env):
                 pass
             else:
                 figs = []
+                # the history builds a new DataFrame on every access
+                hist_df = self.history.df
 
                 # plot cols by theirs structure filtered by the vis_cols param
                 for cols in self.history.structured_cols():
                     if not isinstance(cols, list):
                         cols = [cols]
-                    cols = [col for col in cols if re.fullmatch(self.viz_col_regex, col)]
+                    cols = [col for col in cols if self._viz_match(col)]
                     if not cols:
                         continue
-                    df = self.history.df[cols].copy()
-                    df.index = self.history.df.index * self.time_step_size
+                    df = hist_df[cols].copy()
+                    df.index = hist_df.index * self.time_step_size
 
                     fig, ax = plt.subplots()
                     df.plot(legend=True, figure=fig, ax=ax)
@@ -379,7 +529,7 @@ class ModelicaEnv(gym.Env):
                     fig, ax = plt.subplots()
 
                     for series, kwargs in tmpl:
-                        self.history.df[series].plot(figure=fig, ax=ax, **kwargs)
+                        hist_df[series].plot(figure=fig, ax=ax, **kwargs)
                     tmpl.callback(fig)
                     figs.append(fig)
 
@@ -0,0 +1,196 @@
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from typing import Sequence, Tuple, List, Mapping, Optional
+
+import numpy as np
+
+from openmodelica_microgrid_gym.env.modelica import ModelicaEnv
+
+
+def _worker(conn: Connection, env_kwargs: dict):
+    """
+    Executes commands received through the pipe on an environment owned by this process.
+    The environment and its FMU are created inside the process, because FMU objects can not be pickled.
+    Every command is answered with ('ok', result) or ('error', exception).
+    An error during the creation of the environment is sent as answer to the first command.
+
+    :param conn: child end of the pipe to the ModelicaVecEnv
+    :param env_kwargs: parameters passed to the ModelicaEnv
+    """
+    try:
+        env, init_error = ModelicaEnv(**env_kwargs), None
+    except Exception as e:
+        env, init_error = None, e
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == 'close':
+                break
+            if init_error is not None:
+                conn.send(('error', init_error))
+                break
+            try:
+                if cmd == 'step':
+                    result = env.step(data)
+                elif cmd == 'reset':
+                    result = env.reset()
+                elif cmd == 'spaces':
+                    result = env.action_space, env.observation_space
+                else:
+                    raise ValueError(f'Unknown command {cmd}')
+            except Exception as e:
+                try:
+                    conn.send(('error', e))
+                except Exception:
+                    # the exception itself could not be pickled
+                    conn.send(('error', RuntimeError(repr(e))))
+            else:
+                conn.send(('ok', result))
+    except (EOFError, BrokenPipeError):
+        # the parent is gone
+        pass
+    finally:
+        conn.close()
+
+
+class ModelicaVecEnv:
+    """
+    Vectorized environment running multiple ModelicaEnv in parallel worker processes.
+    Errors raised by an environment are re-raised in the calling process.
+    """
+
+    def __init__(self, n_envs: int, start_method: Optional[str] = None, **env_kwargs):
+        """
+        Runs multiple ModelicaEnv in parallel, each in its own process with its own FMU instance.
+        Only actions and observations are exchanged between the processes.
+
+        :param n_envs: number of environments
+        :param start_method: start method of the worker processes (see multiprocessing.get_context).
+            With 'spawn' or 'forkserver', all env_kwargs (e.g. a reward_fun) must be picklable.
+        :param env_kwargs: parameters of every ModelicaEnv. Visualisation is disabled by default.
+        """
+        env_kwargs.setdefault('viz_mode', None)
+        ctx = mp.get_context(start_method)
+
+        self._conns = []  # type: List[Connection]
+        self._procs = []
+        for _ in range(n_envs):
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(child_conn, env_kwargs), daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._waiting = False
+        self._closed = False
+
+        try:
+            self._send_all('spaces', [None] * n_envs)
+            self.action_space, self.observation_space = self._recv_all()[0]
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def n_envs(self) -> int:
+        return len(self._conns)
+
+    def _send_all(self, cmd: str, data: Sequence):
+        """
+        Sends one command with individual data to every worker.
+
+        :param cmd: command executed by the workers
+        :param data: one data element per worker
+        """
+        for i, (conn, d) in enumerate(zip(self._conns, data)):
+            try:
+                conn.send((cmd, d))
+            except (BrokenPipeError, ConnectionResetError) as e:
+                raise RuntimeError(f'Worker process {i} terminated unexpectedly: {e!r}') from e
+
+    def _recv_all(self) -> list:
+        """
+        Receives one answer from every worker.
+
+        :return: results of all workers
+        :raises: the first exception raised in a worker
+        """
+        results, error = [], None
+        for i, conn in enumerate(self._conns):
+            try:
+                status, result = conn.recv()
+            except (EOFError, ConnectionResetError) as e:
+                status, result = 'error', RuntimeError(f'Worker process {i} terminated unexpectedly: {e!r}')
+            if status == 'error':
+                error = error or result
+            results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def reset(self) -> np.ndarray:
+        """
+        Resets all environments.
+
+        :return: stacked observations of all environments
+        """
+        self._send_all('reset', [None] * self.n_envs)
+        return np.stack(self._recv_all())
+
+    def step_async(self, actions: Sequence[Sequence]):
+        """
+        Sends one action to each environment without waiting for the results.
+
+        :param actions: one action per environment
+        """
+        if len(actions) != self.n_envs:
+            raise ValueError(f'Expected {self.n_envs} actions, one per environment, got {len(actions)}')
+        self._send_all('step', actions)
+        self._waiting = True
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Mapping]]:
+        """
+        Waits for the results of the previous step_async().
+        Environments that are done are not reset automatically.
+
+        :return: stacked observations, rewards, dones and list of infos
+        """
+        try:
+            results = self._recv_all()
+        finally:
+            self._waiting = False
+        obs, rewards, dones, infos = zip(*results)
+        return np.stack(obs), np.array(rewards), np.array(dones), list(infos)
+
+    def step(self, actions: Sequence[Sequence]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Mapping]]:
+        """
+        Steps all environments in parallel.
+
+        :param actions: one action per environment
+        :return: stacked observations, rewards, dones and list of infos
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        """
+        Stops all worker processes.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            # workers might have died already, hence broken pipes are ignored
+            try:
+                if self._waiting:
+                    conn.recv()
+                conn.send(('close', None))
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                pass
+            conn.close()
+        self._waiting = False
+        for proc in self._procs:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
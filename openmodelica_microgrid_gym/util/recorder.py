@@ -1,5 +1,6 @@
 from typing import Sequence, List, Optional, Union
 
+import numpy as np
 import pandas as pd
 
 from openmodelica_microgrid_gym.util.itertools_ import flatten
@@ -75,6 +76,16 @@ class EmptyHistory(StructuredMapping):
         """
         pass
 
+    def preallocate(self, n_rows: int, n_cols: int):
+        """
+        Announce the expected amount of data until the next reset. Must be called after reset().
+        Histories that do not keep all samples ignore this.
+
+        :param n_rows: expected number of appended samples
+        :param n_cols: maximum length of a sample
+        """
+        pass
+
     def last(self):
         return self.df.tail(1).squeeze()
 
@@ -102,16 +113,61 @@ class FullHistory(EmptyHistory):
     Full history that stores all data
     """
 
+    def __init__(self, cols: List[Union[List, str]] = None, data=None, dtype: type = np.float64):
+        """
+
+        :param cols: nested lists of strings providing column names and hierarchical structure
+        :param dtype: floating point dtype of the preallocated storage.
+         np.float32 halves the memory of long episodes at the cost of precision
+        """
+        if not np.issubdtype(dtype, np.floating):
+            # shorter samples are padded with NaN
+            raise ValueError(f'dtype must be a floating point type, not {dtype}')
+        super().__init__(cols, data)
+        self.dtype = dtype
+        self._buf = None
+        self._i = 0
+
     def reset(self):
         self._data = []
+        self._buf = None
+        self._i = 0
+
+    def preallocate(self, n_rows: int, n_cols: int):
+        """
+        Store the following samples in a preallocated array of self.dtype instead of a list.
+        Shorter samples are padded with NaN. If more than n_rows samples are appended, the array is enlarged.
+
+        :param n_rows: expected number of appended samples
+        :param n_cols: maximum length of a sample
+        """
+        self._buf = np.empty((n_rows, n_cols), dtype=self.dtype)
+        self._i = 0
 
     def append(self, values: Sequence):
-        self._data.append(list(values))
+        if self._buf is None:
+            # rows are stored as passed, converting arrays to lists would box every single value
+            self._data.append(values)
+            return
+
+        if self._i == len(self._buf):
+            self._buf = np.concatenate((self._buf, np.empty_like(self._buf)))
+        row = self._buf[self._i]
+        n = len(values)
+        row[:n] = values
+        row[n:] = np.nan
+        self._i += 1
 
     def last(self):
-        return self._data[-1]
+        if self._buf is None:
+            return self._data[-1]
+        if self._i == 0:
+            raise IndexError('The history is empty')
+        return self._buf[self._i - 1].copy()
 
     @property
     def df(self):
-        # executing this conditionally only if _data is not a df is actually slower!!!
-        return pd.DataFrame(self._data, columns=self.cols)
+        if self._buf is None:
+            # executing this conditionally only if _data is not a df is actually slower!!!
+            return pd.DataFrame(self._data, columns=self.cols)
+        return pd.DataFrame(self._buf[:self._i], columns=self.cols)
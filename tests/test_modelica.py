@@ -1,19 +1,25 @@
+import os
+
 import gym
 import numpy as np
 import pytest
 from pytest import approx
 
+from openmodelica_microgrid_gym.env import ModelicaEnv, ModelicaVecEnv
+from openmodelica_microgrid_gym.env.modelica import _color_columns
+
+
+ENV_KWARGS = dict(model_path='fmu/test.fmu',
+                  model_input=['i1p1', 'i1p2', 'i1p3', 'i2p1', 'i2p2', 'i2p3'],
+                  model_output={'lc1': [['inductor1.i', 'inductor2.i', 'inductor3.i'],
+                                        ['capacitor1.v', 'capacitor2.v', 'capacitor3.v']],
+                                'lcl1': [['inductor1.i', 'inductor2.i', 'inductor3.i'],
+                                         ['capacitor1.v', 'capacitor2.v', 'capacitor3.v']]})
+
 
 @pytest.fixture
 def env():
-    env = gym.make('openmodelica_microgrid_gym:ModelicaEnv_test-v1',
-                   viz_mode=None,
-                   model_path='fmu/test.fmu',
-                   model_input=['i1p1', 'i1p2', 'i1p3', 'i2p1', 'i2p2', 'i2p3'],
-                   model_output={'lc1': [['inductor1.i', 'inductor2.i', 'inductor3.i'],
-                                         ['capacitor1.v', 'capacitor2.v', 'capacitor3.v']],
-                                 'lcl1': [['inductor1.i', 'inductor2.i', 'inductor3.i'],
-                                          ['capacitor1.v', 'capacitor2.v', 'capacitor3.v']]})
+    env = gym.make('openmodelica_microgrid_gym:ModelicaEnv_test-v1', viz_mode=None, **ENV_KWARGS)
     return env
 
 
@@ -68,3 +74,111 @@ def test_params_simple():
                           -7.29991175e-01, 1.76505718e+02, 4.10540511e+02, 3.52688013e+01])
     assert r == 1
     assert not done
+
+
+def test_no_log_file(tmp_path, monkeypatch):
+    model_path = os.path.abspath('fmu/test.fmu')
+    monkeypatch.chdir(tmp_path)
+    ModelicaEnv(viz_mode=None, **dict(ENV_KWARGS, model_path=model_path))
+    assert not list(tmp_path.glob('*_log.txt'))
+
+
+def test_color_columns():
+    pattern = np.array([[1, 0, 0, 1],
+                        [0, 1, 0, 0],
+                        [1, 0, 1, 0],
+                        [0, 0, 0, 1]], dtype=bool)
+    colors = _color_columns(pattern)
+    assert [list(cols) for cols in colors] == [[0, 1], [2, 3]]
+    # no row is shared between the columns of a color
+    for cols in colors:
+        assert (pattern[:, cols].sum(axis=1) <= 1).all()
+
+
+def test_sparse_jacobian(env):
+    np.random.seed(1)
+    env.reset()
+    env.step(np.random.random(6))
+    modelica_env = env.unwrapped
+    n = len(modelica_env._state_refs)
+    dense = np.empty((n, n))
+    for j, seed in enumerate(np.eye(n)):
+        dense[:, j] = modelica_env.model.get_directional_derivative(modelica_env._state_refs,
+                                                                    modelica_env._deriv_refs, seed)
+    assert modelica_env._calc_jac(0, None) == approx(dense)
+
+
+@pytest.fixture
+def vec_env():
+    vec_env = ModelicaVecEnv(2, **ENV_KWARGS)
+    yield vec_env
+    vec_env.close()
+
+
+def test_vec_env(env, vec_env):
+    np.random.seed(1)
+    actions = np.random.random((2, 6))
+
+    assert vec_env.reset().shape == (2, 12)
+    obs, r, done, _ = vec_env.step(actions)
+
+    env.reset()
+    assert obs[1] == approx(env.step(actions[1])[0])
+    assert r == approx([1, 1])
+    assert not done.any()
+
+
+def test_vec_env_worker_error(vec_env):
+    vec_env.reset()
+    # wrong number of inputs raises in the workers
+    with pytest.raises(ValueError):
+        vec_env.step(np.zeros((2, 3)))
+    # the workers are still usable afterwards
+    obs, _, _, _ = vec_env.step(np.zeros((2, 6)))
+    assert obs.shape == (2, 12)
+
+
+def test_vec_env_init_error():
+    with pytest.raises(ValueError):
+        ModelicaVecEnv(2, solver_method='unknown', **ENV_KWARGS)
+
+
+def make_solver_env(**kwargs):
+    return gym.make('openmodelica_microgrid_gym:ModelicaEnv_test-v1',
+                    viz_mode=None,
+                    max_episode_steps=100,
+                    **ENV_KWARGS, **kwargs)
+
+
+def run_solver_env(env, n_steps=50):
+    np.random.seed(1)
+    env.reset()
+    for a in np.random.random((n_steps, 6)):
+        obs, _, _, _ = env.step(a)
+    return obs
+
+
+@pytest.mark.parametrize('solver_method', ['OdeSolver', 'unknown', 'solve_ivp'])
+def test_invalid_solver_method(solver_method):
+    with pytest.raises(ValueError):
+        make_solver_env(solver_method=solver_method)
+
+
+def test_solver_warm_start():
+    obs = run_solver_env(make_solver_env())
+    obs_warm = run_solver_env(make_solver_env(solver_warm_start=True))
+    # the results differ within the tolerance of the solver
+    assert obs_warm == approx(obs, rel=1e-2, abs=1e-3)
+
+
+def test_step_rk4():
+    obs = run_solver_env(make_solver_env())
+    obs_rk4 = run_solver_env(make_solver_env(solver_method='RK4'))
+    assert obs_rk4 == approx(obs, rel=1e-2, abs=1e-3)
+
+
+def test_step_cvode():
+    pytest.importorskip('assimulo')
+    obs = run_solver_env(make_solver_env())
+    obs_cvode = run_solver_env(make_solver_env(solver_method='CVode'))
+    assert obs_cvode == approx(obs, rel=1e-2, abs=1e-3)
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import pytest
 
 from openmodelica_microgrid_gym.util import FullHistory
 
@@ -11,3 +12,41 @@ def test__append():
     rec.append([3, 3, 3])
 
     assert rec.df.equals(pd.DataFrame([dict(a=1, b=2, c=3), dict(a=3, b=3, c=3)]))
+
+
+def test__append_preallocated():
+    rec = FullHistory(['a b c'.split()])
+    rec.reset()
+    rec.preallocate(2, 3)
+    rec.append(np.array([1, 2]))
+    rec.append([3, 3, 3])
+    rec.append([4, 4, 4])
+
+    assert np.array_equal(rec.last(), [4, 4, 4])
+    # last() must not expose the internal buffer
+    rec.last()[:] = 0
+    assert rec.df.equals(pd.DataFrame([dict(a=1., b=2., c=np.nan), dict(a=3., b=3., c=3.), dict(a=4., b=4., c=4.)]))
+
+
+def test__append_preallocated_float32():
+    rec = FullHistory(['a b'.split()], dtype=np.float32)
+    rec.reset()
+    rec.preallocate(1, 2)
+    rec.append(np.array([.1, 2]))
+
+    assert (rec.df.dtypes == np.float32).all()
+    assert rec.last()[0] == np.float32(.1)
+
+
+def test__last_preallocated_empty():
+    rec = FullHistory(['a b'.split()])
+    assert rec.df.empty
+    rec.reset()
+    rec.preallocate(2, 2)
+    with pytest.raises(IndexError):
+        rec.last()
+
+
+def test__non_float_dtype():
+    with pytest.raises(ValueError):
+        FullHistory(dtype=np.int64)